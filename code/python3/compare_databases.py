@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import sys
+import xapian
+from support import decode_record
+
+### Start of example code.
+def document_contents(db):
+    # Describe the document for each identifier by its stored fields, its
+    # values, and its terms with their wdfs and positions.
+    contents = {}
+    for item in db.allterms('Q'):
+        for posting in db.postlist(item.term):
+            doc = db.get_document(posting.docid)
+            contents.setdefault(item.term, []).append((
+                decode_record(doc.get_data()),
+                [(value.num, value.value) for value in doc.values()],
+                [
+                    (term.term, term.wdf, list(term.positer))
+                    for term in doc.termlist()
+                ],
+            ))
+    return contents
+
+def compare(dbpath1, dbpath2):
+    contents1 = document_contents(xapian.Database(dbpath1))
+    contents2 = document_contents(xapian.Database(dbpath2))
+
+    differences = 0
+    for idterm in sorted(set(contents1) | set(contents2)):
+        docs1 = contents1.get(idterm, [])
+        docs2 = contents2.get(idterm, [])
+        if docs1 != docs2:
+            print("%s: %i document(s) in %s and %i in %s differ" % (
+                idterm.decode('utf8'), len(docs1), dbpath1, len(docs2),
+                dbpath2))
+            differences += 1
+
+    if differences:
+        print("%i identifiers differ" % differences)
+        sys.exit(1)
+    print("%i documents match" % len(contents1))
+### End of example code.
+
+if len(sys.argv) != 3:
+    print("Usage: %s DBPATH1 DBPATH2" % sys.argv[0])
+    sys.exit(1)
+
+compare(dbpath1 = sys.argv[1], dbpath2 = sys.argv[2])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import sys
+import xapian
+import support
+
+# The searches to check; an empty query string browses every document, so
+# uses the counts stored by index_facets.
+QUERIES = ['', 'watch', 'clock', 'title:sundial']
+
+# The slots to count: COLLECTION, MAKER, and a slot index_facets doesn't
+# use, so has no stored counts.
+SLOTS = (0, 1, 2)
+
+### Start of example code.
+def spy_counts(db, query, slot):
+    # Count the values over every match, as search_facets does.
+    enquire = xapian.Enquire(db)
+    enquire.set_query(query)
+    spy = xapian.ValueCountMatchSpy(slot)
+    enquire.add_matchspy(spy)
+    enquire.get_mset(0, 0, db.get_doccount())
+    return sorted((item.term.decode('utf8'), item.termfreq)
+                  for item in spy.values())
+
+def top_counts(counts, maxvalues):
+    # The counts of the most frequent values, most frequent first.
+    return sorted((count for value, count in counts), reverse=True)[:maxvalues]
+
+def check(dbpath):
+    searcher = support.Searcher(dbpath)
+    facets = support.FacetCounter(searcher, SLOTS)
+    db = searcher.db
+    failed = False
+    for querystring in QUERIES:
+        if querystring:
+            query = searcher.parser.parse_query(querystring)
+        else:
+            query = xapian.Query.MatchAll
+        counts = facets.counts(querystring, checkatleast=db.get_doccount())
+        top = facets.counts(querystring, checkatleast=db.get_doccount(),
+                            maxvalues=3)
+        estimate = facets.estimate(querystring, sample=db.get_doccount())
+        for slot in SLOTS:
+            expected = spy_counts(db, query, slot)
+            problems = []
+            if sorted(counts[slot]) != expected:
+                problems.append("counts gives %s" % (counts[slot],))
+            if (not set(top[slot]) <= set(expected) or
+                    top_counts(top[slot], 3) != top_counts(expected, 3)):
+                problems.append("top 3 gives %s" % (top[slot],))
+            if (not estimate['exact'] or
+                    sorted(estimate['facets'][slot]) != expected):
+                problems.append("estimate gives %s" % (estimate,))
+            if problems:
+                print("'%s' slot %i: %s, a spy gives %s" % (
+                    querystring, slot, "; ".join(problems), expected))
+                failed = True
+            else:
+                print("'%s' slot %i: facet counts match a spy" % (
+                    querystring, slot))
+    if failed:
+        sys.exit(1)
+### End of example code.
+
+if len(sys.argv) != 2:
+    print("Usage: %s DBPATH" % sys.argv[0])
+    sys.exit(1)
+
+check(dbpath = sys.argv[1])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import sys
+import xapian
+import support
+
+# The ranges to check, in the forms search_ranges accepts.  The last is too
+# wide for bucket terms, so is handled as a plain value range.
+RANGES = [
+    '1800..1899',
+    '1650..1949',
+    '1531..1601',
+    '..1700',
+    '1900..',
+    '100..999mm',
+    '45..1260mm',
+    '0..1000000000000mm',
+]
+
+### Start of example code.
+def value_docids(db, querystring):
+    # Parse the range as search_ranges does, so it's checked against the
+    # values of every candidate document.
+    queryparser = xapian.QueryParser()
+    queryparser.add_rangeprocessor(
+        xapian.NumberRangeProcessor(0, 'mm', xapian.RP_SUFFIX)
+    )
+    queryparser.add_rangeprocessor(
+        xapian.NumberRangeProcessor(1)
+    )
+    enquire = xapian.Enquire(db)
+    enquire.set_query(queryparser.parse_query(querystring))
+    return sorted(match.docid for match in
+                  enquire.get_mset(0, db.get_doccount()))
+
+def bucket_docids(searcher, querystring):
+    # Find the same documents using the bucket terms index_ranges adds.
+    results = searcher.search(
+        querystring, 0, searcher.db.get_doccount(), fields=())
+    return sorted(result.docid for result in results)
+
+def check(dbpath):
+    searcher = support.Searcher(dbpath, rangeprocessors=[
+        support.BucketRangeProcessor(
+            0, support.SIZE_BUCKETS, 'mm', xapian.RP_SUFFIX),
+        support.BucketRangeProcessor(
+            1, support.YEAR_BUCKETS, integers=True),
+    ])
+    failed = False
+    for querystring in RANGES:
+        expected = value_docids(searcher.db, querystring)
+        found = bucket_docids(searcher, querystring)
+        if found == expected:
+            print("%s: bucket terms give the same matches" % querystring)
+        else:
+            print("%s: bucket terms give %s, values give %s" % (
+                querystring, found, expected))
+            failed = True
+    if failed:
+        sys.exit(1)
+### End of example code.
+
+if len(sys.argv) != 2:
+    print("Usage: %s DBPATH" % sys.argv[0])
+    sys.exit(1)
+
+check(dbpath = sys.argv[1])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import csv
+import sys
+import tempfile
+from support import sorted_csv_rows
+
+def diff(oldpath, newpath, updatespath, deletespath):
+    # Work out the minimal set of changes to turn an index of the old
+    # file into an index of the new file.  Rows to add or replace are
+    # written to updatespath as CSV (which can be given to index1), and
+    # the identifiers to delete are written to deletespath, one per line.
+    with open(newpath) as fd:
+        fieldnames = next(csv.reader(fd))
+
+    counts = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         open(updatespath, 'w', newline='') as updates, \
+         open(deletespath, 'w') as deletes:
+        writer = csv.DictWriter(updates, fieldnames)
+        writer.writeheader()
+
+        # Walk through both files in identifier order, so we never need
+        # to hold more than a few rows of either in memory.
+        old = sorted_csv_rows(oldpath, 'id_NUMBER', tmpdir)
+        new = sorted_csv_rows(newpath, 'id_NUMBER', tmpdir)
+        old_row = next(old, None)
+        new_row = next(new, None)
+        while old_row is not None or new_row is not None:
+            if new_row is None or (
+                    old_row is not None and old_row[0] < new_row[0]):
+                deletes.write(old_row[0] + '\n')
+                counts['deleted'] += 1
+                old_row = next(old, None)
+            elif old_row is None or new_row[0] < old_row[0]:
+                writer.writerow(new_row[1])
+                counts['added'] += 1
+                new_row = next(new, None)
+            else:
+                if old_row[1] != new_row[1]:
+                    writer.writerow(new_row[1])
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+                old_row = next(old, None)
+                new_row = next(new, None)
+
+    print("%(added)i added, %(updated)i updated, %(deleted)i deleted, "
+          "%(unchanged)i unchanged" % counts)
+
+if len(sys.argv) != 5:
+    print("Usage: %s OLDPATH NEWPATH UPDATESPATH DELETESPATH" % sys.argv[0])
+    sys.exit(1)
+
+diff(oldpath = sys.argv[1], newpath = sys.argv[2],
+     updatespath = sys.argv[3], deletespath = sys.argv[4])
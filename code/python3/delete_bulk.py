@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import sys
+import xapian
+from support import BatchedDatabase, read_identifiers
+
+def delete_docs(dbpath, identifiers, batch):
+    # Open the database we're going to be deleting from, and group the
+    # deletions into explicit transactions, so we control how often
+    # changes are flushed to disk.
+    db = BatchedDatabase(
+        xapian.WritableDatabase(dbpath, xapian.DB_OPEN), batch)
+
+    for identifier in identifiers:
+        idterm = u'Q' + identifier
+        db.delete_document(idterm)
+
+    # Make sure all our changes are written to disk.
+    db.commit()
+
+if len(sys.argv) not in (3, 4):
+    print("Usage: %s DBPATH -|IDFILE [BATCH]" % sys.argv[0])
+    sys.exit(1)
+
+# Stream the identifiers from stdin or a file, one per line.
+if sys.argv[2] == '-':
+    fd = sys.stdin
+else:
+    fd = open(sys.argv[2])
+with fd:
+    delete_docs(dbpath = sys.argv[1], identifiers = read_identifiers(fd),
+                batch = sys.argv[3] if len(sys.argv) > 3 else 1000)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import sys
+import xapian
+from support import (
+    DOCUMENT_BUILDERS, BatchedDatabase, parse_csv_views,
+    store_facet_histograms)
+
+def index(datapath, dbpath, batch, skip_unchanged=False, compact=False,
+          like='index1'):
+    # Create or open the database we're going to be writing to, and group
+    # the updates into explicit transactions, so we control how often
+    # changes are flushed to disk.  With skip_unchanged, documents which
+    # are the same as when they were last indexed aren't written again.
+    db = BatchedDatabase(
+        xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN), batch,
+        skip_unchanged=skip_unchanged)
+
+    # Set up a TermGenerator that we'll use in indexing.
+    termgenerator = xapian.TermGenerator()
+    termgenerator.set_stemmer(xapian.Stem("en"))
+
+    # Build the documents as the example indexer named by like does
+    # (optionally with the fields stored in the compact record format).
+    make_document = DOCUMENT_BUILDERS[like]
+    for fields in parse_csv_views(datapath):
+        idterm, doc = make_document(termgenerator, fields, compact)
+        db.replace_document(idterm, doc)
+
+    if like == 'index_facets':
+        # Store the counts of each collection and maker, as index_facets
+        # does.
+        store_facet_histograms(db, (0, 1))
+
+    # Make sure all our changes are written to disk.
+    db.commit()
+
+args = sys.argv[1:]
+options = {}
+while args[:1] and args[0].startswith('--'):
+    name, _, value = args.pop(0).partition('=')
+    options[name] = value
+like = options.pop('--like', 'index1')
+if (len(args) not in (2, 3) or
+        not set(options) <= set(['--skip-unchanged', '--compact']) or
+        like not in DOCUMENT_BUILDERS):
+    print("Usage: %s [--skip-unchanged] [--compact] [--like=INDEXER] "
+          "DATAPATH DBPATH [BATCH]" % sys.argv[0])
+    print("INDEXER is one of: %s" % ' '.join(sorted(DOCUMENT_BUILDERS)))
+    sys.exit(1)
+
+index(datapath = args[0], dbpath = args[1],
+      batch = args[2] if len(args) > 2 else 1000,
+      skip_unchanged = '--skip-unchanged' in options,
+      compact = '--compact' in options,
+      like = like)
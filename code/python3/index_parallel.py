@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import xapian
+from support import (
+    csv_partitions, make_object_document, parse_csv_views)
+
+### Start of example code.
+def index_shard(datapath, byte_range, shardpath, compact):
+    # Each worker parses its own part of the file and builds its own
+    # shard, with its own TermGenerator.
+    db = xapian.WritableDatabase(shardpath, xapian.DB_CREATE)
+    termgenerator = xapian.TermGenerator()
+    termgenerator.set_stemmer(xapian.Stem("en"))
+
+    for fields in parse_csv_views(datapath, byte_range=byte_range):
+        idterm, doc = make_object_document(termgenerator, fields, compact)
+        db.replace_document(idterm, doc)
+
+    db.close()
+
+def index(datapath, dbpath, nprocs, compact=False):
+    # The shards are merged by compacting them, which creates a new
+    # database, so we can't update an existing one.
+    if os.path.exists(dbpath):
+        print("%s already exists" % dbpath)
+        sys.exit(1)
+
+    # Build the shards next to the final database, so the merge doesn't
+    # have to copy them between filesystems.
+    shardsdir = tempfile.mkdtemp(
+        prefix='shards', dir=os.path.dirname(os.path.abspath(dbpath)))
+
+    try:
+        # Split the file into one part per worker.
+        shards = [
+            (byte_range, os.path.join(shardsdir, str(i)))
+            for i, byte_range in enumerate(csv_partitions(datapath, nprocs))
+        ]
+        if not shards:
+            # There are no rows, so there's nothing to merge.
+            xapian.WritableDatabase(dbpath, xapian.DB_CREATE).close()
+            return
+        workers = [
+            multiprocessing.Process(
+                target=index_shard,
+                args=(datapath, byte_range, shardpath, compact))
+            for byte_range, shardpath in shards
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                print("Indexing worker failed")
+                sys.exit(1)
+
+        # Merge the shards into a single compacted database.  The shards
+        # are in file order, and compaction numbers the documents in the
+        # order the shards are given.
+        db = xapian.Database()
+        for byte_range, shardpath in shards:
+            db.add_database(xapian.Database(shardpath))
+        db.compact(dbpath, xapian.DBCOMPACT_MULTIPASS)
+        db.close()
+    finally:
+        shutil.rmtree(shardsdir)
+
+    # An identifier which appears in more than one part of the file will
+    # have a document in each shard.  Keep the one with the highest docid,
+    # which came from the last row, just as when indexing serially.
+    db = xapian.WritableDatabase(dbpath, xapian.DB_OPEN)
+    duplicates = [
+        item.term for item in db.allterms('Q') if item.termfreq > 1
+    ]
+    for idterm in duplicates:
+        docids = [posting.docid for posting in db.postlist(idterm)]
+        for docid in docids[:-1]:
+            db.delete_document(docid)
+    db.close()
+### End of example code.
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    compact = args[:1] == ['--compact']
+    if compact:
+        del args[0]
+    if len(args) not in (2, 3):
+        print("Usage: %s [--compact] DATAPATH DBPATH [NPROCS]" % sys.argv[0])
+        sys.exit(1)
+
+    if len(args) > 2:
+        nprocs = int(args[2])
+    else:
+        nprocs = multiprocessing.cpu_count()
+
+    index(datapath = args[0], dbpath = args[1], nprocs = nprocs,
+          compact = compact)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import heapq
+import queue
+import sys
+import threading
+import time
+import xapian
+from support import (
+    make_object_document, parse_csv_views, replace_if_changed)
+
+# How many items each queue between stages may hold; when a queue is full
+# the stage feeding it waits, so a slow stage holds back the ones before it.
+QUEUE_SIZE = 256
+
+# How many rows may be between the reader and the writer at once.  The
+# writer holds back documents which are finished out of order, so without
+# this limit one slow row would let it buffer all the rows after it.
+MAX_IN_FLIGHT = 2 * QUEUE_SIZE
+
+# How often (in seconds) a stage waiting on a queue checks whether another
+# stage has failed.
+POLL_INTERVAL = 0.1
+
+class StageCounter(object):
+    """Count the items a pipeline stage handles and the time it spends
+    working on them (as opposed to waiting on its queues).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, busy):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+
+    def report(self, elapsed, threads=1):
+        sys.stderr.write(
+            "%s: %i items, %.0f items/sec busy, %.0f%% utilised\n" % (
+                self.name,
+                self.items,
+                self.items / max(self.busy, 1e-6),
+                100.0 * self.busy / max(elapsed * threads, 1e-6),
+            )
+        )
+
+def put(items, item, abort):
+    # Wait for room in the queue, unless another stage has failed.
+    # Returns False if it has.
+    while not abort.is_set():
+        try:
+            items.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def acquire(slots, abort):
+    # Wait for a free slot in the pipeline, unless another stage has
+    # failed.  Returns False if it has.
+    while not abort.is_set():
+        if slots.acquire(timeout=POLL_INTERVAL):
+            return True
+    return False
+
+def get(items, abort):
+    # Wait for an item from the queue, unless another stage has failed.
+    # Returns None if it has.
+    while not abort.is_set():
+        try:
+            return items.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return None
+
+def read_rows(datapath, rows, nbuilders, counter, abort, in_flight):
+    try:
+        start = time.time()
+        for seq, fields in enumerate(parse_csv_views(datapath)):
+            counter.add(time.time() - start)
+            # The writer frees the slot once the row has been written.
+            if not acquire(in_flight, abort):
+                return
+            if not put(rows, (seq, fields), abort):
+                return
+            start = time.time()
+    except Exception:
+        abort.set()
+        raise
+    finally:
+        # Tell each builder that there's no more input.
+        for i in range(nbuilders):
+            put(rows, None, abort)
+
+def build_documents(rows, docs, counter, abort, compact):
+    # Each builder needs its own TermGenerator.
+    termgenerator = xapian.TermGenerator()
+    termgenerator.set_stemmer(xapian.Stem("en"))
+    try:
+        for seq, fields in iter(lambda: get(rows, abort), None):
+            start = time.time()
+            idterm, doc = make_object_document(termgenerator, fields, compact)
+            counter.add(time.time() - start)
+            if not put(docs, (seq, idterm, doc), abort):
+                return
+    except Exception:
+        abort.set()
+        raise
+    finally:
+        put(docs, None, abort)
+
+def index(datapath, dbpath, nbuilders, skip_unchanged=False,
+          compact=False):
+    # Create or open the database we're going to be writing to.
+    db = xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN)
+
+    # Set when any stage fails, so the others stop rather than waiting for
+    # it forever.
+    abort = threading.Event()
+    rows = queue.Queue(QUEUE_SIZE)
+    docs = queue.Queue(QUEUE_SIZE)
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    reading = StageCounter('read')
+    building = StageCounter('build')
+    writing = StageCounter('write')
+
+    threads = [
+        threading.Thread(target=read_rows,
+                         args=(datapath, rows, nbuilders, reading, abort,
+                               in_flight))
+    ] + [
+        threading.Thread(target=build_documents,
+                         args=(rows, docs, building, abort, compact))
+        for i in range(nbuilders)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # The builders finish documents out of order, so hold them back until
+    # all earlier rows have been written.  That way a repeated identifier
+    # still ends up with the last row for it, as when indexing serially.
+    pending = []
+    next_seq = 0
+    running = nbuilders
+    try:
+        while running:
+            item = get(docs, abort)
+            if item is None:
+                if abort.is_set():
+                    break
+                running -= 1
+                continue
+            heapq.heappush(pending, item)
+            while pending and pending[0][0] == next_seq:
+                seq, idterm, doc = heapq.heappop(pending)
+                start = time.time()
+                if skip_unchanged:
+                    # Don't rewrite documents which haven't changed.
+                    replace_if_changed(db, idterm, doc)
+                else:
+                    db.replace_document(idterm, doc)
+                writing.add(time.time() - start)
+                in_flight.release()
+                next_seq += 1
+    except Exception:
+        abort.set()
+        raise
+
+    for thread in threads:
+        thread.join()
+    if abort.is_set():
+        # A stage failed part way through; its traceback has already been
+        # printed by the threading module.
+        print("Indexing failed after %i rows" % next_seq)
+        sys.exit(1)
+
+    start = time.time()
+    db.commit()
+    writing.busy += time.time() - start
+
+    elapsed = time.time() - started
+    reading.report(elapsed)
+    building.report(elapsed, nbuilders)
+    writing.report(elapsed)
+
+args = sys.argv[1:]
+options = set()
+while args[:1] in (['--skip-unchanged'], ['--compact']):
+    options.add(args.pop(0))
+if len(args) not in (2, 3):
+    print("Usage: %s [--skip-unchanged] [--compact] DATAPATH DBPATH [BUILDERS]"
+          % sys.argv[0])
+    sys.exit(1)
+
+index(datapath = args[0], dbpath = args[1],
+      nbuilders = int(args[2]) if len(args) > 2 else 4,
+      skip_unchanged = '--skip-unchanged' in options,
+      compact = '--compact' in options)
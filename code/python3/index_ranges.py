@@ -3,7 +3,9 @@
 import json
 import sys
 import xapian
-from support import numbers_from_string, parse_csv_file
+from support import (
+    SIZE_BUCKETS, YEAR_BUCKETS, numbers_from_string, parse_csv_file,
+    range_bucket_terms)
 
 def index(datapath, dbpath):
     # Create or open the database we're going to be writing to.
@@ -50,6 +52,16 @@ def index(datapath, dbpath):
             doc.add_value(1, xapian.sortable_serialise(years[0]))
 ### End of example code.
 
+        # Also index which size band and decade and century the object
+        # falls in, so BucketRangeProcessor can find most of the objects in
+        # a range without checking their values.
+        if len(measurements) > 0 and len(numbers) > 0:
+            for term in range_bucket_terms(SIZE_BUCKETS, max(numbers)):
+                doc.add_boolean_term(term)
+        if len(years) > 0:
+            for term in range_bucket_terms(YEAR_BUCKETS, years[0]):
+                doc.add_boolean_term(term)
+
         # We use the identifier to ensure each object ends up in the
         # database only once no matter how many times we run the
         # indexer.
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import sys
+import xapian
+import support
+
+# The sorts to check: each is a list of (slot, reverse) pairs, as for
+# support.Searcher.  The last is the sort from search_sorting2.
+SORTS = [
+    [(1, False)],
+    [(1, True)],
+    [(3, True)],
+    [(1, False), (3, True)],
+]
+
+### Start of example code.
+def sorted_docids(db, query, sort):
+    # Run the search in one go, sorted as search_sorting2 does.
+    enquire = xapian.Enquire(db)
+    enquire.set_query(query)
+    keymaker = xapian.MultiValueKeyMaker()
+    for slot, reverse in sort:
+        keymaker.add_value(slot, reverse)
+    enquire.set_sort_by_key_then_relevance(keymaker, False)
+    return [match.docid for match in enquire.get_mset(0, db.get_doccount())]
+
+def paged_docids(searcher, querystring, sort, pagesize):
+    # Fetch the same results a page at a time.
+    docids = []
+    cursor = None
+    while True:
+        results, cursor = searcher.search_after(
+            querystring, cursor, pagesize, fields=(), sort=sort)
+        docids.extend(result.docid for result in results)
+        if cursor is None:
+            return docids
+
+def check(dbpath, querystring, pagesize):
+    searcher = support.Searcher(dbpath)
+    query = searcher.parser.parse_query(querystring)
+    failed = False
+    for sort in SORTS:
+        expected = sorted_docids(searcher.db, query, sort)
+        paged = paged_docids(searcher, querystring, sort, pagesize)
+        if paged == expected:
+            print("%s: pages match a single search" % (sort,))
+        else:
+            print("%s: pages give %s, a single search gives %s" % (
+                sort, paged, expected))
+            failed = True
+    if failed:
+        sys.exit(1)
+### End of example code.
+
+if len(sys.argv) < 4:
+    print("Usage: %s DBPATH PAGESIZE QUERYTERM..." % sys.argv[0])
+    sys.exit(1)
+
+check(dbpath = sys.argv[1], querystring = " ".join(sys.argv[3:]),
+      pagesize = int(sys.argv[2]))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import asyncio
+import sys
+import support
+
+### Start of example code.
+async def search_all(dbpath, querystrings, offset=0, pagesize=10, timeout=10):
+    # Run all the searches at once, two at a time on a pool of threads,
+    # giving each of them timeout seconds (including any time spent
+    # waiting for a free thread).
+    searcher = support.AsyncSearcher(dbpath, threads=2, timeout=timeout)
+    try:
+        replies = await asyncio.gather(*[
+            searcher.search(querystring, offset, pagesize, ('TITLE',))
+            for querystring in querystrings
+        ], return_exceptions=True)
+    finally:
+        searcher.close()
+
+    # And print out something about each match, in the same way as search1
+    # does, in the order the searches were given.
+    for querystring, reply in zip(querystrings, replies):
+        if isinstance(reply, asyncio.TimeoutError):
+            print("'%s' timed out" % querystring)
+            continue
+        if isinstance(reply, Exception):
+            raise reply
+        for match in reply:
+            print(u"%(rank)i: #%(docid)3.3i %(title)s" % {
+                'rank': match.rank + 1,
+                'docid': match.docid,
+                'title': match.fields.get('TITLE', u''),
+                })
+        support.log_matches(querystring, offset, pagesize,
+                            [match.docid for match in reply])
+### End of example code.
+
+if len(sys.argv) < 3:
+    print("Usage: %s DBPATH QUERY..." % sys.argv[0])
+    sys.exit(1)
+
+asyncio.run(search_all(dbpath = sys.argv[1], querystrings = sys.argv[2:]))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import json
+import sys
+import time
+import support
+
+def search(dbpath, querypath, threads):
+    # Read the queries, one per line.  A line can either be a query string,
+    # or a JSON object as described in support.search_batch().
+    queries = []
+    with open(querypath) as fd:
+        for line in fd:
+            line = line.strip()
+            if line.startswith('{'):
+                queries.append(json.loads(line))
+            elif line:
+                queries.append(line)
+
+    start = time.time()
+    results = support.search_batch(dbpath, queries, threads, ('TITLE',))
+    elapsed = time.time() - start
+
+    # Output the results for each query as a line of JSON.
+    for result in results:
+        print(json.dumps(result))
+    sys.stderr.write("%i queries in %.2fs using %i threads\n" % (
+        len(results), elapsed, threads))
+
+if len(sys.argv) not in (3, 4):
+    print("Usage: %s DBPATH QUERYFILE [THREADS]" % sys.argv[0])
+    sys.exit(1)
+
+search(dbpath = sys.argv[1], querypath = sys.argv[2],
+       threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import json
+import socket
+import sys
+import support
+
+def search(socketpath, querystring, offset=0, pagesize=10):
+    # Send the query to a running search_service, and print out the
+    # results in the same way as search1 does.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socketpath)
+    with sock, sock.makefile('rwb') as fd:
+        request = {
+            'query': querystring,
+            'offset': offset,
+            'pagesize': pagesize,
+        }
+        fd.write(json.dumps(request).encode('utf8') + b'\n')
+        fd.flush()
+        reply = json.loads(fd.readline().decode('utf8'))
+
+    if 'error' in reply:
+        print("Search failed: %s" % reply['error'])
+        sys.exit(1)
+
+    matches = []
+    for match in reply['matches']:
+        print(u"%(rank)i: #%(docid)3.3i %(title)s" % {
+            'rank': match['rank'] + 1,
+            'docid': match['docid'],
+            'title': match['fields'].get('TITLE', u''),
+            })
+        matches.append(match['docid'])
+
+    # Finally, make sure we log the query and displayed results
+    support.log_matches(querystring, offset, pagesize, matches)
+
+if len(sys.argv) < 3:
+    print("Usage: %s SOCKETPATH QUERYTERM..." % sys.argv[0])
+    sys.exit(1)
+
+search(socketpath = sys.argv[1], querystring = " ".join(sys.argv[2:]))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import support
+
+class SearchHandler(socketserver.StreamRequestHandler):
+    """Handle requests from a client, one JSON object per line.
+
+    Each request has a "query", and optionally "offset", "pagesize",
+    "filters" (a list of boolean terms) and either "sort" (a list of
+    [slot, reverse] pairs) or "near" (a [latitude, longitude] pair to sort
+    by distance from).  The reply is a JSON object with a list of "matches",
+    or an "error".
+
+    Instead of an offset, a request without "near" can give a "cursor":
+    null for the first page, or the "cursor" from the reply for the
+    previous page.
+    """
+    def handle(self):
+        searcher = self.server.get_searcher()
+        try:
+            self.handle_requests(searcher)
+        finally:
+            self.server.put_searcher(searcher)
+
+    def handle_requests(self, searcher):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf8'))
+                reply = {}
+                if 'cursor' in request:
+                    if 'near' in request:
+                        raise ValueError("Can't page by cursor with near")
+                    matches, reply['cursor'] = searcher.search_after(
+                        request['query'],
+                        request['cursor'],
+                        request.get('pagesize', 10),
+                        ('TITLE',),
+                        request.get('filters', ()),
+                        request.get('sort'),
+                    )
+                else:
+                    matches = searcher.search(
+                        request['query'],
+                        request.get('offset', 0),
+                        request.get('pagesize', 10),
+                        ('TITLE',),
+                        request.get('filters', ()),
+                        request.get('sort'),
+                        near=request.get('near'),
+                    )
+                reply['matches'] = [match.as_dict() for match in matches]
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode('utf8') + b'\n')
+            self.wfile.flush()
+
+class SearchServer(socketserver.ThreadingUnixStreamServer):
+    """Handle each connection on its own thread.
+
+    Xapian objects mustn't be used from several threads at once, so each
+    connection has a Searcher to itself while it's open.  Searchers are
+    kept for later connections once they're finished with, and all of
+    them share one cache of results.
+    """
+    daemon_threads = True
+
+    def __init__(self, socketpath, dbpath, cache):
+        socketserver.ThreadingUnixStreamServer.__init__(
+            self, socketpath, SearchHandler)
+        self.dbpath = dbpath
+        self.cache = cache
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get_searcher(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return support.Searcher(self.dbpath, cache=self.cache)
+
+    def put_searcher(self, searcher):
+        with self.lock:
+            self.idle.append(searcher)
+
+def serve(dbpath, socketpath, cache_entries=1000, cache_bytes=16 << 20):
+    server = SearchServer(
+        socketpath, dbpath, support.RevisionCache(cache_entries, cache_bytes))
+    # Make sure we clean up the socket when we're asked to stop.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socketpath)
+
+if len(sys.argv) != 3:
+    print("Usage: %s DBPATH SOCKETPATH" % sys.argv[0])
+    sys.exit(1)
+
+try:
+    serve(dbpath = sys.argv[1], socketpath = sys.argv[2])
+except KeyboardInterrupt:
+    pass
@@ -456,7 +456,7 @@ class XapianRunExample(LiteralInclude):
         source = self.state_machine.get_source_and_line()[0]
         if current_source != source:
             # New file, so clean up databases.
-            os.system("rm -rf db filtersdb statesdb")
+            os.system("rm -rf db filtersdb statesdb paralleldb")
             current_source = source
 
         ex = self.arguments[0]